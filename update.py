@@ -187,19 +187,280 @@ def runOrFail(command, *args, **kwds):
             err)
         fail("Exiting with failure")
 
-def runTests(repo):
+### Test selection stuff
+
+# Full test runs record, under coverage, which files each test file
+# touches. Those maps are kept in {coverageStore}/{repo}/{commit}.yaml
+# so that later runs just pass the test files touching the files
+# changed by the new commits. Files are relative to the working path.
+# coverageStore is made absolute on startup, relative to the working path.
+# Files covered only outside test functions (setUp, fixtures, imports)
+# can not be attributed to a test file, so changing them runs all tests.
+
+def isTestFile(path):
+    name = os.path.basename(path)
+    return name.endswith('.py') and (
+        name.startswith('test') or name.endswith('_test.py')
+        or any(part in ('test','tests') for part in path.split('/')[:-1])
+    )
+
+def nosetestsTargets(command):
+    """
+    Splits a nosetests command into options and target paths,
+    returns None if the command cannot be narrowed.
+    """
+    args = command.split()
+    if not args or args[0] != 'nosetests':
+        return None
+    options = [arg for arg in args[1:] if arg.startswith('-')]
+    targets = [arg for arg in args[1:] if not arg.startswith('-')]
+    if not targets or any(':' in target for target in targets):
+        return None
+    return options, [
+        target if os.path.exists(target) else target.replace('.','/')
+        for target in targets
+    ]
+
+def isUnderTargets(path, targets):
+    return any(
+        path == target or path.startswith(target.rstrip('/')+'/')
+        for target in targets
+    )
+
+def isInsideErpModule(path):
+    path = os.path.abspath(path)
+    while path != os.path.dirname(path):
+        if os.path.exists(os.path.join(path, '__terp__.py')):
+            return True
+        path = os.path.dirname(path)
+    return False
+
+def coverageMapFile(repo, commit):
+    return Path(c.coverageStore)/repo.path/'{}.yaml'.format(commit)
+
+def loadCoverageMap(repo, commit):
+    """
+    Returns the coverage map recorded for the commit, if any,
+    with 'tests' as a dict from test file to covered files.
+    """
+    if not commit: return None
+    mapfile = coverageMapFile(repo, commit)
+    if not mapfile.exists(): return None
+    coverageMap = ns.load(str(mapfile))
+    # Kept as a list and a plain dict since yamlns splits dotted keys
+    tests = coverageMap.get('tests')
+    if not isinstance(tests, list) or not all(
+            isinstance(entry, dict) and 'testfile' in entry
+            and isinstance(entry.get('files'), list)
+            for entry in tests):
+        warn("Ignoring malformed coverage map '{}'", mapfile)
+        return None
+    coverageMap.tests = dict(
+        (entry.testfile, entry.files)
+        for entry in tests
+    )
+    return coverageMap
+
+def saveCoverageMap(repo, coverageMap):
+    mapfile = coverageMapFile(repo, coverageMap.commit)
+    mapfile.parent.mkdir(parents=True, exist_ok=True)
+    ns(coverageMap,
+        tests = [
+            ns(testfile=testfile, files=files)
+            for testfile, files in sorted(coverageMap.tests.items())
+        ],
+    ).dump(str(mapfile))
+
+def coverageRunCommand(repo, command, root):
+    "Wraps a nosetests command to record coverage per test"
+    repoStore = Path(c.coverageStore)/repo.path
+    repoStore.mkdir(parents=True, exist_ok=True)
+    rcfile = repoStore/'coveragerc'
+    rcfile.write_text(
+        u"[run]\n"
+        u"dynamic_context = test_function\n"
+        u"data_file = {}\n"
+        u"source = {}\n"
+        .format(repoStore/'coverage-data', root),
+        encoding='utf8')
+    return "coverage run --rcfile={} -m nose {}".format(
+        rcfile, command[len('nosetests'):].strip())
+
+def collectCoverageMap(repo, root):
+    """
+    Returns, from the data of the last coverage run, a dict 'tests'
+    mapping each test file in the repo to the files covered by its tests,
+    and 'fixtureFiles', the files just covered outside any test function.
+    """
+    import json
+    repoStore = Path(c.coverageStore)/repo.path
+    jsonfile = repoStore/'coverage.json'
+    code, _, _, _ = baseRun("coverage json --rcfile={} --show-contexts -o {} > /dev/null",
+        repoStore/'coveragerc', jsonfile)
+    if code:
+        warn("No coverage data recorded for {path}", **repo)
+        return ns(tests={}, fixtureFiles=[])
+    data = json.loads(jsonfile.read_text(encoding='utf8'))
+    jsonfile.unlink()
+
+    contextFiles = {}
+    outsideTests = set()
+    for filename, filedata in data['files'].items():
+        filename = os.path.relpath(os.path.abspath(filename), root)
+        for contexts in filedata.get('contexts', {}).values():
+            for context in contexts:
+                if not context:
+                    outsideTests.add(filename)
+                    continue
+                contextFiles.setdefault(context, set()).add(filename)
+    insideTests = set().union(*contextFiles.values())
+
+    prefix = repo.path.rstrip('/')+'/'
+    coverageMap = {}
+    for files in contextFiles.values():
+        for testfile in files:
+            if not testfile.startswith(prefix): continue
+            if not isTestFile(testfile): continue
+            coverageMap.setdefault(testfile[len(prefix):], set()).update(files)
+    return ns(
+        tests=dict(
+            (testfile, sorted(files))
+            for testfile, files in coverageMap.items()
+        ),
+        fixtureFiles=sorted(outsideTests - insideTests),
+    )
+
+def changedFiles(results):
+    "Files changed by the new commits in all repos, relative to the working path"
+    return set(
+        os.path.join(path, filename)
+        for path, commits in results.get('changes', ns()).items()
+        for commit in commits
+        if isinstance(commit, dict)
+        for filename in commit.files
+    )
+
+def selectTests(repo, targets, coverageMap, changed):
+    """
+    Returns the test files under targets touching any changed file,
+    along with any new, renamed or modified test file.
+    """
+    prefix = repo.path.rstrip('/')+'/'
+    changedTests = [
+        filename[len(prefix):]
+        for filename in changed
+        if filename.startswith(prefix)
+        and isTestFile(filename[len(prefix):])
+        and os.path.exists(filename[len(prefix):])
+    ]
+    return sorted(set(
+        testfile
+        for testfile, files in coverageMap.items()
+        if changed.intersection(files)
+        and os.path.exists(testfile)
+    ).union(changedTests).intersection(
+        testfile
+        for testfile in set(coverageMap).union(changedTests)
+        if isUnderTargets(testfile, targets)
+    ))
+
+def testPlan(repo, results):
+    """
+    Decides whether the repo tests run in full, recording coverage maps,
+    or selected from the coverage map recorded before the new commits.
+    Returns the map to select from, or None for a full run.
+    """
+    if not c.coverageStore:
+        return None
+    if c.fullTests:
+        warn("Full test run forced")
+        return None
+    if not changedFiles(results):
+        warn("No changed files to select tests from, running all tests")
+        return None
+    state = results.get('repositories', ns()).get(repo.path)
+    coverageMap = loadCoverageMap(repo, state and state.local)
+    if coverageMap is None:
+        warn("No coverage map for {path}, running all tests", **repo)
+        return None
+    fullRunDate = datetime.datetime.strptime(
+        format(coverageMap.fullRunDate), '%Y-%m-%d').date()
+    age = datetime.date.today() - fullRunDate
+    if age.days >= c.fullTestsDays:
+        warn("Coverage map for {path} is {days} days old, running all tests",
+            days=age.days, **repo)
+        return None
+    return coverageMap
+
+def runTests(repo, results):
+    root = os.getcwd()
+    commit = readRepositoryRefs(repo).local
+    coverageMap = testPlan(repo, results)
+    changed = changedFiles(results)
+    # Tests inside erp modules drive the server, whose code (erp core,
+    # modules, editable libraries) is out of the sight of coverage,
+    # so any change other than tests runs them in full
+    codeChanged = any(not isTestFile(filename) for filename in changed)
+    fixtureChanged = coverageMap is not None and bool(
+        changed.intersection(coverageMap.get('fixtureFiles', [])))
+    if fixtureChanged:
+        warn("Changed files used outside test functions, running all tests")
+    recorded = ns(tests={}, fixtureFiles=set())
+
     errors = []
-    for command in repo.tests:
-        commandResult = ns(command=command)
-        errors.append(commandResult)
-        code, out, err, mix = baseRun(command)
-        if code:
-            error("Test failed: {}", command)
-            commandResult.update(
-                failed = True,
-                errorcode=code,
-                output = mix,
-            )
+    with cd(repo.path):
+        for command in repo.tests:
+            commandResult = ns(command=command)
+            errors.append(commandResult)
+            nose = c.coverageStore and nosetestsTargets(command)
+            if nose:
+                options, targets = nose
+                if (coverageMap is not None and not fixtureChanged
+                        and not (codeChanged and any(
+                            isInsideErpModule(target) for target in targets))):
+                    known = [
+                        testfile for testfile in coverageMap.tests
+                        if isUnderTargets(testfile, targets)
+                    ]
+                    selected = selectTests(repo, targets, coverageMap.tests, changed)
+                    if not known:
+                        # A map without these tests would skip them forever
+                        warn("No test of the coverage map under the targets, "
+                            "running in full: {}", command)
+                    elif not selected:
+                        commandResult.selected = selected
+                        warn("No test affected by the changes: {}", command)
+                        continue
+                    else:
+                        commandResult.selected = selected
+                        command = ' '.join(['nosetests'] + options + selected)
+                command = coverageRunCommand(repo, command, root)
+            code, out, err, mix = baseRun(command)
+            if nose:
+                collected = collectCoverageMap(repo, root)
+                recorded.tests.update(collected.tests)
+                recorded.fixtureFiles.update(collected.fixtureFiles)
+            if code:
+                error("Test failed: {}", command)
+                commandResult.update(
+                    failed = True,
+                    errorcode=code,
+                    output = mix,
+                )
+
+    if c.coverageStore and commit:
+        # Selected runs refresh the entries of the tests they ran
+        coverageData = ns(
+            commit = commit,
+            fullRunDate = format(datetime.date.today()),
+            tests = {},
+            fixtureFiles = [],
+        ) if coverageMap is None else coverageMap
+        coverageData.commit = commit
+        coverageData.tests.update(recorded.tests)
+        coverageData.fixtureFiles = sorted(recorded.fixtureFiles.union(
+            coverageData.get('fixtureFiles', [])))
+        saveCoverageMap(repo, coverageData)
     return errors
 
 def testRepositories(p, results):
@@ -208,9 +469,8 @@ def testRepositories(p, results):
     for repo in p.repositories:
         if 'tests' not in repo: continue
         step("Testing {}", repo.path)
-        with cd(repo.path):
-            result = runTests(repo)
-            results.failures[repo.path] = result
+        result = runTests(repo, results)
+        results.failures[repo.path] = result
 
 
 def summary(results):
@@ -234,21 +494,24 @@ def hasChanges(results):
 def newCommitsFromRemote(repo):
     output = captureOrFail(
         #"git log HEAD..HEAD@{{upstream}} " # old version
-        "git log ..origin/{branch} "
-            " --pretty=format:'%h\t%ai\t%s'"
+        "git log ..origin/{branch} --name-only"
+            " --pretty=format:'%x00%h\t%ai\t%s'"
             .format(**repo))
 
-    return [
-        ns(
-            id=id,
-            date=date,
-            subject=subject,
-            )
-        for id, date, subject in (
-            line.split('\t')
-            for line in output.splitlines()
-        )
-    ]
+    commits = []
+    for line in output.splitlines():
+        if not line: continue
+        if line.startswith('\0'):
+            id, date, subject = line[1:].split('\t', 2)
+            commits.append(ns(
+                id=id,
+                date=date,
+                subject=subject,
+                files=[],
+                ))
+            continue
+        commits[-1].files.append(line)
+    return commits
 
 def rebase():
     errorcode, _,_, mix = baseRun("git rebase")
@@ -259,8 +522,103 @@ def rebase():
 def fetch():
     runOrFail("git fetch --all")
 
-def currentBranch():
-    return captureOrFail("git rev-parse --abbrev-ref HEAD").strip()
+def gitDir(path):
+    "Returns the git dir for a working copy, following .git files of worktrees"
+    dotgit = Path(path)/'.git'
+    if dotgit.is_file():
+        gitdir = Path(dotgit.read_text(encoding='utf8').split(':',1)[1].strip())
+        return gitdir if gitdir.is_absolute() else Path(path)/gitdir
+    return dotgit
+
+def gitCommonDir(gitdir):
+    "Worktrees keep their own HEAD but share refs with the main repository"
+    commondir = gitdir/'commondir'
+    if not commondir.exists():
+        return gitdir
+    common = Path(commondir.read_text(encoding='utf8').strip())
+    return common if common.is_absolute() else gitdir/common
+
+def readPackedRefs(gitdir):
+    packedRefs = gitdir/'packed-refs'
+    if not packedRefs.exists():
+        return {}
+    return dict(
+        (line.split()[1], line.split()[0])
+        for line in packedRefs.read_text(encoding='utf8').splitlines()
+        if line and line[0] not in '#^'
+    )
+
+def readRef(gitdir, packedRefs, ref):
+    "Resolves a ref without calling git, None if it does not exist"
+    loose = gitdir/ref
+    if loose.is_file():
+        return loose.read_text(encoding='utf8').strip()
+    return packedRefs.get(ref)
+
+def readRepositoryRefs(repo):
+    """
+    Reads the current branch, its tip and the tip of origin/{branch}
+    directly from HEAD, the loose refs and packed-refs.
+    """
+    gitdir = gitDir(repo.path)
+    commondir = gitCommonDir(gitdir)
+    packedRefs = readPackedRefs(commondir)
+    head = (gitdir/'HEAD').read_text(encoding='utf8').strip()
+    if head.startswith('ref:'):
+        headRef = head[len('ref:'):].strip()
+        branch = headRef[len('refs/heads/'):]
+        local = readRef(commondir, packedRefs, headRef)
+    else: # detached, as reported by rev-parse --abbrev-ref
+        branch = 'HEAD'
+        local = head
+    upstream = readRef(commondir, packedRefs,
+        'refs/remotes/origin/{branch}'.format(**repo))
+    return ns(
+        branch = branch,
+        local = local,
+        upstream = upstream,
+    )
+
+def scanRepositories(p):
+    """
+    Returns, for every existing repository, a table with
+    the branch, local and upstream tips, ahead and behind counts
+    and whether the working copy has uncommited changes.
+    Refs are read from disk, and git is called just once,
+    batching the ahead/behind counts of diverged repos and the dirty checks.
+    """
+    step("Scanning repositories state")
+    states = ns()
+    queries = []
+    for repo in p.repositories:
+        if repo.path in states: continue
+        if not os.path.exists(repo.path): continue
+        state = readRepositoryRefs(repo)
+        state.update(ahead=0, behind=0, dirty=False)
+        states[repo.path] = state
+        if not state.upstream:
+            state.update(ahead=None, behind=None)
+        counts = (
+            'git -C {path} rev-list --left-right --count {local}...{upstream}'
+            if state.local and state.upstream and state.local != state.upstream
+            else 'echo {ahead} {behind}'
+            )
+        queries.append((
+            'echo {path} $(' + counts + ') '
+            '$(git -C {path} status --porcelain --untracked-files=no | wc -l)'
+            ).format(path=repo.path, **state))
+
+    if not queries:
+        return states
+    output = captureOrFail('; '.join(queries))
+    for line in output.splitlines():
+        path, ahead, behind, dirty = line.split()
+        states[path].update(
+            ahead = None if ahead == 'None' else int(ahead),
+            behind = None if behind == 'None' else int(behind),
+            dirty = int(dirty) > 0,
+        )
+    return states
 
 def clone(repository):
     """
@@ -284,49 +642,60 @@ def fetchOrCloneRepository(repo):
     step("Fetching changes {path}",**repo)
     with cd(repo.path):
         fetch()
-        branch = currentBranch()
-        if branch != repo.branch:
-            warn("Not rebasing repo '{path}': "
-                "in branch '{currentBranch}' instead of '{branch}'",
-                currentBranch=branch, **repo)
-            return repo.path, []
-        repoChanges = newCommitsFromRemote(repo)
-        return repo.path, repoChanges
-
+    return repo.path, []
+
+def isInWorkingBranch(repo, state):
+    if state.branch == repo.branch:
+        return True
+    warn("Not rebasing repo '{path}': "
+        "in branch '{currentBranch}' instead of '{branch}'",
+        currentBranch=state.branch, **repo)
+    return False
 
 def cloneOrUpdateRepositories(p, results):
+    changes = results.setdefault('changes',ns())
     if c.fetchingProcesses>1:
         warn("Repos will be fetched {} at a time to speedup, expect mixed output".format(c.fetchingProcesses))
         from multiprocessing import Pool
-        changes = results.setdefault('changes',ns())
         workers = Pool(c.fetchingProcesses)
-        changes.update(
-            (path, pathchanges)
-            for path,pathchanges in workers.imap_unordered(fetchOrCloneRepository, p.repositories)
-            if pathchanges)
+        fetched = list(workers.imap_unordered(fetchOrCloneRepository, p.repositories))
         warn("End of mixed repos fetch")
         workers.close()
-        return
+    else:
+        fetched = [fetchOrCloneRepository(repo) for repo in p.repositories]
+
+    changes.update(
+        (path, pathchanges)
+        for path,pathchanges in fetched
+        if pathchanges)
+
+    states = results.repositories = scanRepositories(p)
     for repo in p.repositories:
-        fetchOrCloneRepository(repo)
+        if repo.path in changes: continue
+        state = states[repo.path]
+        if not state.behind: continue
+        if not isInWorkingBranch(repo, state): continue
+        with cd(repo.path):
+            changes[repo.path] = newCommitsFromRemote(repo)
 
 def rebaseRepositories(p, results):
     changes = results.setdefault('changes',ns())
+    states = results.repositories
     for repo in p.repositories:
         if not os.path.exists(repo.path):
             raise Exception("Repo {} missing")
         step("Updating repo {path}",**repo)
+        state = states[repo.path]
+        if not isInWorkingBranch(repo, state):
+            continue
+        if not changes.get(repo.path, None) or not state.behind:
+            warn("No changes detected")
+            continue
+        if state.dirty:
+            warn("Not rebasing repo '{path}': uncommited changes", **repo)
+            continue
+        step("Rebasing {path}",**repo)
         with cd(repo.path):
-            branch = currentBranch()
-            if branch != repo.branch:
-                warn("Not rebasing repo '{path}': "
-                    "in branch '{currentBranch}' instead of '{branch}'",
-                    currentBranch=branch, **repo)
-                continue
-            if not changes.get(repo.path, None):
-                warn("No changes detected")
-                continue
-            step("Rebasing {path}",**repo)
             rebase()
 
 
@@ -423,18 +792,107 @@ def installCustomPdfGenerator():
     runOrFail("rm libpng12-0_1.2.54-1ubuntu1.1_amd64.deb wkhtmltox-0.12.2.1_linux-trusty-amd64.deb")
 
 
+### Addons stuff
+
+def findAddons(repopath, excluded):
+    "Yields the erp module dirs (having a __terp__.py) inside a repository"
+    for dirpath, dirnames, filenames in os.walk(repopath):
+        if '__terp__.py' in filenames:
+            dirnames[:] = []
+            yield dirpath
+            continue
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if not d.startswith('.')
+            and os.path.abspath(os.path.join(dirpath, d)) != excluded
+        )
+
+def desiredAddonLinks(p, addonsDir):
+    """
+    Returns a dict module name -> absolute module path for all the modules
+    in the configured repositories. On name clashes, first repo wins.
+    """
+    addonsDir = os.path.abspath(addonsDir)
+    links = ns()
+    for repo in p.repositories:
+        if not os.path.exists(repo.path): continue
+        for addon in findAddons(repo.path, addonsDir):
+            name = os.path.basename(addon)
+            if links.get(name) == os.path.abspath(addon): continue
+            if name in links:
+                warn("Module {} found both in {} and {}, using the first",
+                    name, links[name], addon)
+                continue
+            links[name] = os.path.abspath(addon)
+    return links
+
+def linkAddons(p, results):
+    """
+    Links the modules of the repositories into the erp addons dir,
+    creating, updating or removing just the links which differ.
+    The changes are kept in results.addonLinks for later stages.
+    """
+    addonsDir = Path(p.get('addonsDir', 'erp/server/bin/addons'))
+    step("Linking addons into {}", addonsDir)
+    desired = desiredAddonLinks(p, str(addonsDir))
+    repoPaths = [os.path.abspath(repo.path)+os.sep for repo in p.repositories]
+    changes = results.addonLinks = ns(created=[], updated=[], removed=[])
+
+    existing = ns()
+    for link in addonsDir.iterdir():
+        if not link.is_symlink(): continue
+        existing[link.name] = os.path.abspath(
+            os.path.join(str(addonsDir), os.readlink(str(link))))
+
+    for name, target in existing.items():
+        if name in desired: continue
+        if os.path.exists(target) and not any(
+                target.startswith(repoPath) for repoPath in repoPaths):
+            continue # Not ours
+        (addonsDir/name).unlink()
+        changes.removed.append(name)
+
+    for name, target in desired.items():
+        link = addonsDir/name
+        if existing.get(name) == target: continue
+        if name in existing:
+            link.unlink()
+            changes.updated.append(name)
+        elif os.path.lexists(str(link)):
+            warn("Not linking module {}: {} already exists", name, link)
+            continue
+        else:
+            changes.created.append(name)
+        link.symlink_to(os.path.relpath(target, str(addonsDir)))
+
+    for change, modules in changes.items():
+        if modules:
+            warn("Addon links {}: {}", change, ', '.join(sorted(modules)))
+    return changes
+
+
 ### Database stuff
 
-def downloadLastBackup():
-    backupfile = None
+def lastBackupFile():
     yesterday = format((datetime.datetime.now()-datetime.timedelta(days=1)).date())
 
     if c.reuseBackup:
         for backupfile in sorted(Path(c.workingpath).glob('somenergia-*.sql.gz')):
-            break
+            return backupfile
 
-    if not backupfile:
-        backupfile = Path("somenergia-{}.sql.gz".format(yesterday))
+    return Path("somenergia-{}.sql.gz".format(yesterday))
+
+def backupFileDate(backupfile):
+    "Returns the date in a somenergia-YYYY-MM-DD.sql.gz file name"
+    import re
+    match = re.match(r'somenergia-(\d{4}-\d{2}-\d{2})\.sql\.gz$', backupfile.name)
+    if not match:
+        fail("Unable to tell the date of backup '{}'".format(backupfile))
+    return match.group(1)
+
+def downloadLastBackup():
+    yesterday = (datetime.datetime.now()-datetime.timedelta(days=1)).date()
+    backupfile = lastBackupFile()
 
     if backupfile.exists() and not c.forceDownload:
         warn("Reusing already downloaded '{}'", backupfile)
@@ -444,18 +902,241 @@ def downloadLastBackup():
     runOrFail("scp somdevel@sp2:{} {}", remotefile, backupfile)
     return backupfile
 
+### Backup store stuff
+
+# Daily dumps are nearly identical, so instead of keeping a full
+# somenergia-YYYY-MM-DD.sql.gz per day, the backup store splits the
+# decompressed dump in content defined chunks, keeps every distinct
+# chunk once, and a manifest per date listing the chunks in order.
+#
+# Layout:
+#   {store}/chunks/ab/abcdef...  zlib compressed chunk, named by sha1
+#   {store}/manifests/YYYY-MM-DD  one chunk name per line
+#
+# A source is another store, either a local path or 'host:/path' over ssh.
+
+backupChunkMinSize = 256*1024
+backupChunkMaxSize = 4*1024*1024
+backupChunkMask = 0x1fff # cut on average every 8k lines above the min size
+
+def backupChunks(stream):
+    """
+    Splits a line based stream (a sql dump) into content defined chunks.
+    Cut points depend on the content of the lines, not on their offset,
+    so an insertion just changes the chunks around it.
+    """
+    import zlib
+    lines = []
+    size = 0
+    for line in stream:
+        lines.append(line)
+        size += len(line)
+        if size < backupChunkMinSize: continue
+        if size < backupChunkMaxSize and zlib.crc32(line) & backupChunkMask:
+            continue
+        yield b''.join(lines)
+        lines = []
+        size = 0
+    if lines:
+        yield b''.join(lines)
+
+def backupChunkName(chunkid):
+    return '{}/{}'.format(chunkid[:2], chunkid)
+
+def backupChunkPath(store, chunkid):
+    return Path(store)/'chunks'/backupChunkName(chunkid)
+
+def backupManifestPath(store, date):
+    return Path(store)/'manifests'/format(date)
+
+def backupStoreDates(store):
+    "Returns the dates with a manifest in the store, oldest first"
+    manifests = Path(store)/'manifests'
+    if not manifests.exists():
+        return []
+    return sorted(
+        manifest.name
+        for manifest in manifests.iterdir()
+        if not manifest.name.startswith('.')
+    )
+
+def readBackupManifest(manifest):
+    return Path(manifest).read_text(encoding='utf8').split()
+
+def writeAtomically(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.parent/('.'+path.name+'.tmp')
+    tmp.write_bytes(content)
+    tmp.rename(path)
+
+def storeBackup(store, date, backupfile):
+    "Adds a gzipped sql dump to the store as the given date"
+    import gzip
+    import hashlib
+    import zlib
+    step("Storing backup '{}' as {}", backupfile, date)
+    manifest = []
+    newChunks = 0
+    with gzip.open(str(backupfile), 'rb') as stream:
+        for chunk in backupChunks(stream):
+            chunkid = hashlib.sha1(chunk).hexdigest()
+            manifest.append(chunkid)
+            chunkfile = backupChunkPath(store, chunkid)
+            if chunkfile.exists(): continue
+            writeAtomically(chunkfile, zlib.compress(chunk))
+            newChunks += 1
+    writeAtomically(backupManifestPath(store, date),
+        u''.join(chunkid+u'\n' for chunkid in manifest).encode('utf8'))
+    success("Stored {} chunks, {} of them new", len(manifest), newChunks)
+    return manifest
+
+def backupStoreStream(store, date):
+    "Yields the decompressed dump for the date, chunk by chunk"
+    import hashlib
+    import zlib
+    for chunkid in readBackupManifest(backupManifestPath(store, date)):
+        chunk = zlib.decompress(backupChunkPath(store, chunkid).read_bytes())
+        if hashlib.sha1(chunk).hexdigest() != chunkid:
+            fail("Corrupted chunk {} in backup store {}"
+                .format(chunkid, store))
+        yield chunk
+
+def isRemoteBackupSource(source):
+    host, sep, path = source.partition(':')
+    return bool(sep) and '/' not in host
+
+def fetchBackupFromSource(store, source, date):
+    """
+    Brings the manifest for the date from a source store,
+    transfering just the chunks missing in the local store.
+    """
+    import shutil
+    step("Fetching backup {} from {}", date, source)
+    manifest = backupManifestPath(store, date)
+    incoming = manifest.parent/('.'+manifest.name+'.incoming')
+    incoming.parent.mkdir(parents=True, exist_ok=True)
+    (Path(store)/'chunks').mkdir(parents=True, exist_ok=True)
+
+    remote = isRemoteBackupSource(source)
+    if remote:
+        host, _, sourcepath = source.partition(':')
+        runOrFail("scp {}:{}/manifests/{} {}", host, sourcepath, date, incoming)
+    else:
+        shutil.copy(str(Path(source)/'manifests'/format(date)), str(incoming))
+
+    missing = sorted(set(
+        chunkid
+        for chunkid in readBackupManifest(incoming)
+        if not backupChunkPath(store, chunkid).exists()
+    ))
+    warn("Transfering {} missing chunks", len(missing))
+
+    if not missing:
+        pass
+    elif remote:
+        missingList = Path(store)/'.missing-chunks'
+        missingList.write_text(
+            u''.join(backupChunkName(chunkid)+u'\n' for chunkid in missing),
+            encoding='utf8')
+        runOrFail("ssh {} 'tar cf - -C {}/chunks -T -' < {} | tar xf - -C {}/chunks",
+            host, sourcepath, missingList, store)
+        missingList.unlink()
+    else:
+        for chunkid in missing:
+            chunkfile = backupChunkPath(store, chunkid)
+            chunkfile.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy(str(backupChunkPath(source, chunkid)), str(chunkfile))
+
+    incoming.rename(manifest)
+    return manifest
+
+def pruneBackupStore(store, keptDays):
+    "Removes all but the last keptDays manifests and the chunks no longer referenced"
+    step("Pruning backup store, keeping {} days", keptDays)
+    dates = backupStoreDates(store)
+    for date in dates[:-keptDays]:
+        backupManifestPath(store, date).unlink()
+    referenced = set(
+        chunkid
+        for date in dates[-keptDays:]
+        for chunkid in readBackupManifest(backupManifestPath(store, date))
+    )
+    for chunkfile in (Path(store)/'chunks').glob('*/*'):
+        if chunkfile.name not in referenced:
+            chunkfile.unlink()
+
+def updateBackupStore():
+    "Ensures yesterday's backup is in the store and returns the date to restore"
+    dates = backupStoreDates(c.backupStore)
+    if c.reuseBackup and dates:
+        warn("Reusing stored backup for {}", dates[-1])
+        return dates[-1]
+
+    yesterday = (datetime.datetime.now()-datetime.timedelta(days=1)).date()
+    if format(yesterday) in dates and not c.forceDownload:
+        warn("Reusing already stored backup for {}", yesterday)
+        return format(yesterday)
+
+    if c.backupSource:
+        fetchBackupFromSource(c.backupStore, c.backupSource, yesterday)
+        date = format(yesterday)
+    else:
+        # Just remove the dumps downloaded here, not the ones found locally
+        downloaded = not lastBackupFile().exists()
+        backupfile = downloadLastBackup()
+        date = backupFileDate(backupfile)
+        storeBackup(c.backupStore, date, backupfile)
+        if downloaded:
+            backupfile.unlink()
+    pruneBackupStore(c.backupStore, c.backupStoreDays)
+    return date
+
+def restoreFromBackupStore(store, date, dbname):
+    "Pipes the stored dump for the date into psql"
+    running("[Backup store {}] {} | psql -e {}", store, date, dbname)
+    process = subprocess.Popen(['psql', '-e', dbname],
+        stdin=subprocess.PIPE)
+    try:
+        for chunk in backupStoreStream(store, date):
+            process.stdin.write(chunk)
+    finally:
+        process.stdin.close()
+        process.wait()
+    code, _, _, _ = endrun(process.returncode, [], [], [])
+    if code:
+        error("Restoring backup {} failed with code {}", date, code)
+        fail("Exiting with failure")
+
 def dbExists(dbname):
     out = captureOrFail("""psql postgres -tAc "SELECT 1 FROM pg_database WHERE datname='{}'" """,
         dbname)
     return out.strip()=="1"
 
-def loadDb(p):
-        backupfile = downloadLastBackup()
-        runOrFail("dropdb --if-exists {dbname}", **c)
-        runOrFail("createdb {dbname}", **c)
-        runOrFail("( pv -f {} | zcat | psql -e {dbname} ) 2>&1", backupfile, **c)
-        runOrFail("""psql -d {dbname} -c "UPDATE res_partner_address SET email = '{email}'" """, **c)
-        runOrFail("{workingpath}/somenergia-utils/enable_destructive_tests.py --i-am-sure",**c)
+def loadDb(p, dbname):
+        if c.backupStore:
+            date = updateBackupStore()
+            runOrFail("dropdb --if-exists {}", dbname)
+            runOrFail("createdb {}", dbname)
+            restoreFromBackupStore(c.backupStore, date, dbname)
+        else:
+            backupfile = downloadLastBackup()
+            runOrFail("dropdb --if-exists {}", dbname)
+            runOrFail("createdb {}", dbname)
+            runOrFail("( pv -f {} | zcat | psql -e {} ) 2>&1", backupfile, dbname)
+        runOrFail("""psql -d {} -c "UPDATE res_partner_address SET email = '{email}'" """, dbname, **c)
+
+def stagingDatabase():
+    return '{dbname}_staging'.format(**c)
+
+def replaceDatabase(staging, dbname):
+    step("Replacing database {} by {}", dbname, staging)
+    runOrFail("dropdb --if-exists {}", dbname)
+    runOrFail("""psql postgres -c 'ALTER DATABASE "{}" RENAME TO "{}"' """,
+        staging, dbname)
+
+def enableDestructiveTests():
+    step("Enabling destructive tests")
+    runOrFail("{workingpath}/somenergia-utils/enable_destructive_tests.py --i-am-sure",**c)
 
 
 def firstTimeSetup(p,c,results):
@@ -468,26 +1149,35 @@ def createLogDir(p,c,results):
     logdir = Path(c.virtualenvdir)/'var/log'
     logdir.mkdir(parents=True, exist_ok=True)
 
-def generateErpRunner(p,c,results):
-    "Generates an erp server runner based on the .in template"
-
-    step("Generating Erp Runner")
-    runner = Path(c.virtualenvdir) / 'bin/erpserver'
+def writeErpRunner(runner, **overrides):
+    "Writes an erp server runner based on the .in template"
+    params = ns(c,
+        erpconf=Path(c.virtualenvdir)/'conf/erp.conf',
+        editablesPath='',
+    )
+    params.update(overrides)
     runnerTemplate = srcdir / 'erpserver.in'
-    content = runnerTemplate.read_text(encoding='utf8').format(**c)
+    content = runnerTemplate.read_text(encoding='utf8').format(**params)
     runner.write_text(content, encoding='utf8')
     runner.chmod(0o744)
 
-def generateErpConf(p,c,results):
-    "Generates an erp conf file based on the .in template"
-
-    step("Generating Erp Configuration")
-    somenergiaConf = Path(c.virtualenvdir)/'conf/erp.conf'
+def writeErpConf(somenergiaConf, **overrides):
+    "Writes an erp conf file based on the template"
+    params = ns(c, logfile=Path(c.virtualenvdir)/'var/log/erp/erp_server.log')
+    params.update(overrides)
     somenergiaConf.parent.mkdir(parents=True, exist_ok=True)
     confTemplate = srcdir / 'erp.conf'
-    confContent = confTemplate.read_text(encoding='utf8').format(**c)
+    confContent = confTemplate.read_text(encoding='utf8').format(**params)
     somenergiaConf.write_text(confContent, encoding='utf8')
 
+def generateErpRunner(p,c,results):
+    step("Generating Erp Runner")
+    writeErpRunner(Path(c.virtualenvdir) / 'bin/erpserver')
+
+def generateErpConf(p,c,results):
+    step("Generating Erp Configuration")
+    writeErpConf(Path(c.virtualenvdir)/'conf/erp.conf')
+
 def setupDBUsers(p,c,results):
     # This requires the following line on the sudoers
     # youruser  ALL = (postgres) /path/to/pgaduser.sh
@@ -498,33 +1188,210 @@ def setupDBUsers(p,c,results):
     for user in p.postgresUsers:
         runOrFail("sudo -u postgres {}/pgadduser.sh {}", srcdir, user)
 
-def isErpPortOpen():
+def isErpPortOpen(port=None):
     try:
-        s = socket.create_connection(('localhost', c.erpport), timeout=4)
+        s = socket.create_connection(('localhost', port or c.erpport), timeout=4)
     except socket.error as ex:
         return False
     s.close()
     return True
 
-def waitErpOpen():
+def waitErpOpen(port=None):
     for i in range(c.erpStartupTimeout):
-        if isErpPortOpen():
+        if isErpPortOpen(port):
             return True
         time.sleep(1)
     return False
 
-def deploy(p, results):
-    stage("Deploy")
-    if c.skipDeploy:
-        warn("Deployment skipped")
-        return
+### Deploy scheduling
+
+# Deploy actions are tasks declaring the tasks they run after ('after')
+# and the resources they use ('uses'). Independent tasks run concurrently,
+# each in its own process so that they can 'cd' freely, as long as
+# c.deployResources limits are kept. Each task reports its steps and
+# results changes back to the parent, which adds them to the current stage.
+# A task returning False skips the tasks depending on it, and terminates
+# or skips the ones listing it in 'skippedWith'.
+# On the first failure, the running tasks are terminated. Terminated tasks
+# lose their steps, so just a 'Terminated: <task>' step is recorded.
+
+def deployTask(name, action, after=[], uses=[], skippedWith=[]):
+    return ns(
+        name=name,
+        action=action,
+        after=after,
+        uses=uses,
+        skippedWith=skippedWith,
+    )
+
+def taskFailure(exception, steps):
+    "Describes a task failure by the exception and the command it failed on"
+    description = type(exception).__name__
+    if not isinstance(exception, SystemExit) and u(str(exception)):
+        description += u": " + u(str(exception))
+    commands = [command for step in steps for command in step.commands]
+    failedCommands = [command for command in commands if command.get('failed')]
+    lastCommand = (failedCommands or commands or [None])[-1]
+    if lastCommand is not None:
+        description += u", on command: " + lastCommand.command
+    return description
+
+def runDeployTask(task, p, results, queue):
+    import copy
+    os.setsid() # so that terminating the task also kills its commands
+    stageName = currentStage().name
+    del progress.stages[:]
+    progress.stages.append(ns(name=stageName, steps=[]))
+    before = copy.deepcopy(ns(
+        (key, value) for key, value in results.items() if key != 'progress'))
+    outcome = ns(name=task.name)
+    try:
+        outcome.proceed = task.action(p, results) is not False
+    except BaseException as e:
+        outcome.failed = taskFailure(e, progress.stages[-1].steps)
+    outcome.steps = progress.stages[-1].steps
+    outcome.results = ns(
+        (key, value)
+        for key, value in results.items()
+        if key != 'progress'
+        and before.get(key) != value
+    )
+    queue.put(outcome)
 
+def mergeTaskResults(results, taskResults):
+    for key, value in taskResults.items():
+        if isinstance(value, dict) and isinstance(results.get(key), dict):
+            results[key].update(value)
+        else:
+            results[key] = value
+
+def waitTaskOutcome(queue, running):
+    "Waits for the next finished task, also if it dies without reporting"
+    try:
+        from queue import Empty
+    except ImportError:
+        from Queue import Empty
+    while True:
+        try:
+            return queue.get(timeout=5)
+        except Empty:
+            pass
+        for name, task in running.items():
+            if task.process.exitcode:
+                return ns(
+                    name=name,
+                    failed="Process died with code {}".format(task.process.exitcode),
+                    steps=[ns(name="Died: {}".format(name), commands=[])],
+                    results=ns(),
+                )
+
+def terminateTasks(running, names=None):
+    for name, task in list(running.items()):
+        if names is not None and name not in names: continue
+        # its own steps die with it
+        step("Terminated: {}", name)
+        try:
+            os.killpg(task.process.pid, signal.SIGTERM)
+        except OSError:
+            task.process.terminate()
+        task.process.join()
+        del running[name]
+
+def scheduleTasks(tasks, p, results, processes=None):
+    from multiprocessing import Process, Queue
+    names = [task.name for task in tasks]
+    for task in tasks:
+        for dependency in task.after + task.skippedWith:
+            if dependency not in names:
+                fail("Task '{}' runs after unknown task '{}'"
+                    .format(task.name, dependency))
+
+    queue = Queue()
+    pending = list(tasks)
+    running = ns()
+    done = []
+    skipped = []
+    failed = []
+    busy = dict((resource, 0) for resource in c.deployResources)
+
+    def canStart(task):
+        return (
+            len(running) < (processes or c.deployProcesses)
+            and all(dependency in done for dependency in task.after)
+            and all(
+                busy.get(resource, 0) < c.deployResources.get(resource, 1)
+                for resource in task.uses
+            )
+        )
+
+    try:
+        while pending or running:
+            for task in list(pending):
+                if any(dependency in skipped
+                        for dependency in task.after + task.skippedWith):
+                    warn("Skipping task '{}'", task.name)
+                    pending.remove(task)
+                    skipped.append(task.name)
+                    continue
+                if not canStart(task):
+                    continue
+                pending.remove(task)
+                for resource in task.uses:
+                    busy[resource] = busy.get(resource, 0) + 1
+                process = Process(target=runDeployTask,
+                    args=(task, p, results, queue))
+                running[task.name] = ns(task=task, process=process)
+                process.start()
+                if len(running) > 1:
+                    warn("Running tasks {}, expect mixed output",
+                        ', '.join(running))
+
+            if not running:
+                if pending:
+                    fail("Tasks can not be scheduled, check dependency cycles: {}"
+                        .format(', '.join(task.name for task in pending)))
+                break
+
+            outcome = waitTaskOutcome(queue, running)
+            if outcome.name not in running:
+                continue # reported just before being terminated
+            finished = running.pop(outcome.name)
+            finished.process.join()
+            for resource in finished.task.uses:
+                busy[resource] -= 1
+            currentStage().steps.extend(outcome.steps)
+            mergeTaskResults(results, outcome.results)
+            if outcome.get('failed'):
+                error("Task '{}' failed: {}", outcome.name, outcome.failed)
+                failed.append(outcome.name)
+                break
+            if outcome.proceed:
+                done.append(outcome.name)
+                continue
+            skipped.append(outcome.name)
+            cancelled = [
+                task.task for task in running.values()
+                if outcome.name in task.task.skippedWith
+            ]
+            terminateTasks(running, [task.name for task in cancelled])
+            for task in cancelled:
+                for resource in task.uses:
+                    busy[resource] -= 1
+                skipped.append(task.name)
+    finally:
+        terminateTasks(running)
+
+    if failed:
+        fail("Exiting with failure")
+
+def installAptDependencies(p, results):
     missingApt = missingAptPackages(p.ubuntuDependencies)
     if missingApt:
         aptInstall(p.ubuntuDependencies)
     if missingAptPackages(['wkhtmltox']):
         installCustomPdfGenerator()
 
+def installPipRequirements(p, results):
     missingPip = missingPipRequirements(p.pipDependencies)
     if missingPip:
         warn("Missing pip packages: {}", missingPip)
@@ -533,35 +1400,337 @@ def deploy(p, results):
     if c.upgradePipPackages:
         pipInstallUpgrade(pendingPipUpgrades(), results)
 
+def updateRepositories(p, results):
     # TODO: on deploy, add both gisce and som rolling remotes
 
     cloneOrUpdateRepositories(p, results)
 
     if not hasChanges(results) and not c.runUnchanged:
         warn("No changes detected, exiting")
-        return
+        return False
 
     rebaseRepositories(p, results)
 
+def installEditables(p, results):
     if c.skipPipUpgrade:
         warn("Skiping pip editables install")
-    else:
-        # TODO: Just the ones updated or cloned
-        for path in p.editablePackages:
-            installEditable(path)
-
-    # TODO: Just a first time or if one repo is cloned
-    with cd('erp'):
-        runOrFail("./tools/link_addons.sh > /dev/null")
+        return
+    # TODO: Just the ones updated or cloned
+    for path in p.editablePackages:
+        installEditable(path)
 
+def setupIfFirstTime(p, results):
     somenergiaConf = Path(c.virtualenvdir)/'conf/erp.conf'
     if not somenergiaConf.exists():
         firstTimeSetup(p,c,results)
 
-    if dbExists(c.dbname) and c.keepDatabase:
+def prepareDatabase(p, results):
+    "Restores into a staging database, not to lose the current one if nothing changed"
+    step("Preparing database {dbname}", **c)
+    results.databaseRestored = not (dbExists(c.dbname) and c.keepDatabase)
+    if not results.databaseRestored:
         warn("Keeping existing database")
-    else:
-        loadDb(p)
+        return
+    loadDb(p, stagingDatabase())
+
+def installDatabase(p, results):
+    if results.databaseRestored:
+        replaceDatabase(stagingDatabase(), c.dbname)
+        enableDestructiveTests()
+    if c.blameProcesses and (
+            results.databaseRestored or not dbExists(blameTemplate())):
+        createBlameTemplate()
+
+def deployTasks(p):
+    return [
+        deployTask('apt', installAptDependencies,
+            uses=['apt', 'network']),
+        deployTask('pip', installPipRequirements,
+            after=['apt'], uses=['venv', 'network']),
+        deployTask('repositories', updateRepositories,
+            uses=['network']),
+        deployTask('editables', installEditables,
+            after=['pip', 'repositories'], uses=['venv']),
+        deployTask('addons', linkAddons,
+            after=['repositories']),
+        deployTask('setup', setupIfFirstTime,
+            after=['apt'], uses=['database']),
+        deployTask('database', prepareDatabase,
+            after=['setup'], uses=['database', 'network'],
+            skippedWith=['repositories']),
+        deployTask('installDatabase', installDatabase,
+            after=['database', 'repositories'], uses=['database']),
+    ]
+
+def deploy(p, results):
+    stage("Deploy")
+    if c.skipDeploy:
+        warn("Deployment skipped")
+        return
+
+    scheduleTasks(deployTasks(p), p, results)
+
+
+### Blame stuff
+
+# When tests fail, the new commits of all the repos are merged in a single
+# timeline, and the failing command is run on several prefixes of it at
+# once, narrowing the first failing one in a few rounds.
+# Each candidate is tested in a slot, {blamePath}/slotN, having git
+# worktrees for the changed repos and the erp, and links to the other repos,
+# its own database, cloned from a template taken after restoring,
+# and its own erp port and configuration. Tests may read the port and
+# database from ERP_PORT and ERP_DB. Suites not doing so still talk to
+# the configured erp, so the first round checks the failure reproduces
+# in a slot, and nothing is blamed if it does not.
+# Both the slot erp and the tests get the slot editable packages
+# in PYTHONPATH before the venv ones, which point to the main tree.
+
+def blameTemplate():
+    return '{dbname}_blametemplate'.format(**c)
+
+def createBlameTemplate():
+    step("Creating database template for blame")
+    runOrFail("dropdb --if-exists {}", blameTemplate())
+    runOrFail("createdb -T {dbname} {}", blameTemplate(), **c)
+
+def commitTime(commit):
+    "Parses git %ai dates into utc"
+    date, hour, zone = commit.date.split()
+    local = datetime.datetime.strptime(date+' '+hour, '%Y-%m-%d %H:%M:%S')
+    offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5]))
+    return local + offset if zone[0] == '-' else local - offset
+
+def commitsTimeline(results):
+    """
+    Merges the new commits of all the repos in a single timeline,
+    oldest first, keeping the order within each repo.
+    """
+    pending = ns(
+        (path, list(reversed(commits)))
+        for path, commits in results.get('changes', ns()).items()
+        if commits and isinstance(commits[0], dict)
+    )
+    timeline = []
+    while any(pending.values()):
+        path = min(
+            (path for path, commits in pending.items() if commits),
+            key=lambda path: commitTime(pending[path][0]))
+        timeline.append(ns(pending[path].pop(0), repo=path))
+    return timeline
+
+def blameBases(p, results):
+    """
+    Returns the commit for every repo before the new commits:
+    the tip before rebasing for the changed ones, the current one otherwise.
+    """
+    states = results.get('repositories', ns())
+    bases = ns()
+    for repo in p.repositories:
+        if not os.path.exists(repo.path): continue
+        if repo.path in results.get('changes', ns()) and repo.path in states:
+            bases[repo.path] = states[repo.path].local
+        else:
+            bases[repo.path] = readRepositoryRefs(repo).local
+    return bases
+
+def candidateCommits(bases, timeline, applied):
+    "Commit for every repo after applying the first commits of the timeline"
+    commits = ns(bases)
+    for commit in timeline[:applied]:
+        commits[commit.repo] = commit.id
+    return commits
+
+def bisectPoints(good, bad, count):
+    "Up to count evenly spaced points strictly between good and bad"
+    span = bad - good
+    count = min(count, span-1)
+    return [good + span*i//(count+1) for i in range(1, count+1)]
+
+def blameSlotDir(slot):
+    return Path(c.blamePath).absolute()/'slot{}'.format(slot)
+
+def setupBlameSlots(p, bases, worktreeRepos):
+    """
+    Creates the slots, sequentially, since concurrent
+    worktree additions on the same repo collide.
+    """
+    step("Setting up {} blame slots", c.blameProcesses)
+    for path in worktreeRepos:
+        runOrFail("git -C {} worktree prune", path)
+    for slot in range(c.blameProcesses):
+        slotdir = blameSlotDir(slot)
+        for path, commit in bases.items():
+            target = slotdir/path
+            if path not in worktreeRepos:
+                if not os.path.lexists(str(target)):
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    target.symlink_to(Path(path).absolute())
+                continue
+            if target.is_symlink():
+                target.unlink()
+            if not target.exists():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                runOrFail("git -C {} worktree add --detach {} {}",
+                    path, target, commit)
+
+def testCandidate(p, repo, command, slot, commits):
+    "Runs the test command with the given commits in the slot, True if it passes"
+    slotdir = blameSlotDir(slot)
+    dbname = '{}_blame{}'.format(c.dbname, slot)
+    port = c.erpport + 1 + slot
+    step("Testing {} in slot {}: {}", repo.path, slot, ' '.join(
+        '{}@{}'.format(path, commit[:8])
+        for path, commit in commits.items()
+        if not (slotdir/path).is_symlink()))
+
+    for path, commit in commits.items():
+        if (slotdir/path).is_symlink(): continue
+        runOrFail("git -C {} checkout --quiet --force --detach {}",
+            slotdir/path, commit)
+    with cd(str(slotdir)):
+        linkAddons(p, ns())
+
+    runOrFail("dropdb --if-exists {}", dbname)
+    runOrFail("createdb -T {} {}", blameTemplate(), dbname)
+
+    slotParams = ns(
+        workingpath=str(slotdir),
+        dbname=dbname,
+        erpport=port,
+    )
+    editables = [str(slotdir/path) for path in p.editablePackages]
+    writeErpConf(slotdir/'erp.conf',
+        logfile=slotdir/'erp_server.log', **slotParams)
+    runner = slotdir/'erpserver'
+    writeErpRunner(runner,
+        erpconf=slotdir/'erp.conf',
+        editablesPath=''.join(path+os.pathsep for path in editables),
+        **slotParams)
+
+    os.environ.update(
+        PYTHONPATH=os.pathsep.join(
+            editables + [os.environ.get('PYTHONPATH', '')]),
+        ERP_PORT=str(port),
+        ERP_DB=dbname,
+    )
+    if not c.skipErpUpdate:
+        code, _, _, _ = baseRun('{} --update=all --stop-after-init --logfile=""', runner)
+        if code:
+            return False
+
+    if isErpPortOpen(port):
+        fail("Another erp instance is using the port {}".format(port))
+    with background(str(runner)):
+        if not waitErpOpen(port):
+            error("Erp took more than {} seconds to startup", c.erpStartupTimeout)
+            return False
+        with cd(str(slotdir/repo.path)):
+            code, _, _, _ = baseRun(command)
+    return code == 0
+
+def blameCandidateTask(repo, command, slot, commits, applied):
+    def action(p, results):
+        passed = testCandidate(p, repo, command, slot, commits)
+        results.setdefault('blameRuns', ns())[applied] = passed
+    return deployTask('blame {}'.format(applied), action)
+
+def testCandidates(p, results, repo, command, timeline, bases, points):
+    """
+    Tests the timeline prefixes in points, blameProcesses at a time.
+    Returns a dict telling whether each one passed, and the rounds used.
+    """
+    runs = ns()
+    rounds = 0
+    for first in range(0, len(points), c.blameProcesses):
+        rounds += 1
+        scheduleTasks([
+            blameCandidateTask(repo, command, slot,
+                candidateCommits(bases, timeline, applied), applied)
+            for slot, applied in enumerate(points[first:first+c.blameProcesses])
+            ], p, results, processes=c.blameProcesses)
+        runs.update(results.pop('blameRuns'))
+    return runs, rounds
+
+def blameCommand(p, results, repo, command, timeline, bases):
+    """
+    Returns the first commit in the timeline making the command fail,
+    testing up to blameProcesses prefixes of the timeline per round.
+    The first round also checks, in the slots, that the command fails
+    with all the new commits and passed before them.
+    """
+    blame = ns(
+        repo=repo.path,
+        command=command,
+        culprit=None,
+        rounds=0,
+    )
+    good, bad = 0, len(timeline)
+    points = [bad, good] + bisectPoints(good, bad, c.blameProcesses-2)
+    while True:
+        runs, rounds = testCandidates(
+            p, results, repo, command, timeline, bases, points)
+        blame.rounds += rounds
+        if runs.get(len(timeline)):
+            warn("'{}' does not fail in the blame slots", command)
+            blame.notReproducible = True
+            return blame
+        if 0 in runs and not runs[0]:
+            warn("'{}' already failed in the blame slots before the new commits",
+                command)
+            blame.alreadyFailing = True
+            return blame
+        good = max([good] + [
+            applied for applied, passed in runs.items()
+            if passed and applied < bad])
+        bad = min([bad] + [
+            applied for applied, passed in runs.items()
+            if not passed and applied > good])
+        if bad - good <= 1:
+            break
+        points = bisectPoints(good, bad, c.blameProcesses)
+
+    culprit = timeline[bad-1]
+    blame.culprit = ns(
+        repo=culprit.repo,
+        id=culprit.id,
+        date=culprit.date,
+        subject=culprit.subject,
+    )
+    success("Blamed {repo} {id}: {subject}", **blame.culprit)
+    return blame
+
+def failingTestCommands(p, results):
+    "Yields the repos and the commands, as they were run, which failed"
+    seen = set()
+    for repo in p.repositories:
+        if repo.path in seen: continue
+        seen.add(repo.path)
+        for commandResult in results.get('failures', ns()).get(repo.path, []):
+            if not commandResult.get('failed'): continue
+            command = commandResult.command
+            if commandResult.get('selected'):
+                options, targets = nosetestsTargets(command)
+                command = ' '.join(['nosetests'] + options + commandResult.selected)
+            yield repo, command
+
+def blameFailures(p, results):
+    failing = list(failingTestCommands(p, results))
+    if not failing:
+        return
+    stage("Blame")
+    timeline = commitsTimeline(results)
+    if not timeline:
+        warn("No new commits to blame")
+        return
+    bases = blameBases(p, results)
+    erp = p.get('addonsDir', 'erp/server/bin/addons').split('/')[0]
+    worktreeRepos = sorted(set(commit.repo for commit in timeline).union([erp]))
+    setupBlameSlots(p, bases, worktreeRepos)
+    results.blame = [
+        blameCommand(p, results, repo, command, timeline, bases)
+        for repo, command in failing
+    ]
 
 
 def dumpTestfarmData(p,results):
@@ -624,6 +1793,18 @@ def dumpTestfarmData(p,results):
             failedTasks=failures,
         )
 
+    for blame in results.get('blame', []):
+        client(
+            name="Blame {repo}: {command}".format(**blame),
+            failedTasks=[
+                "Not reproducible in the blame slots"
+                if blame.get('notReproducible') else
+                "Already failing before the new commits"
+                if blame.get('alreadyFailing') else
+                "{repo} {id} {subject}".format(**blame.culprit)
+            ],
+        )
+
     import json
     jsondata = json.dumps(report,
         indent=4,
@@ -658,11 +1839,28 @@ c = ns(
     erpStartupTimeout = 30,
     fetchingProcesses = 10,
     upgradePipPackages=False,
+    coverageStore = None,
+    fullTests = False,
+    fullTestsDays = 7,
+    blameProcesses = 0,
+    blamePath = 'blame',
+    deployProcesses = 4,
+    deployResources = ns(
+        network = 3,
+        database = 1,
+        venv = 1,
+        apt = 1,
+    ),
+    backupStore = None,
+    backupSource = None,
+    backupStoreDays = 7,
 )
 c.update(**ns.load("config.yaml"))
 
 
-@click.command(help="Executes a build setup/update of the erp")
+@click.group(help="Executes a build setup/update of the erp",
+    invoke_without_command=True)
+@click.pass_context
 @click.option('--execname','name',
     metavar='EXECNAME',
     help='Execution name',
@@ -706,12 +1904,25 @@ c.update(**ns.load("config.yaml"))
     is_flag=True,
     default=None,
     )
+@click.option('--fulltests', 'fullTests',
+    help='Runs all the tests, refreshing the coverage maps used to select them',
+    is_flag=True,
+    default=None,
+    )
+@click.option('--blame', 'blameProcesses',
+    metavar='N',
+    type=int,
+    help='Looks for the commits breaking failed tests, testing N commits at a time',
+    default=None,
+    )
 @click.option('--rununchanged', 'runUnchanged',
     help='Proceed even if no changes are detected in repositories',
     is_flag=True,
     default=None,
     )
-def main(**kwds):
+def main(ctx, **kwds):
+    if ctx.invoked_subcommand:
+        return
     c.update((k,v) for k,v in kwds.items() if v is not None)
     print(c.dump())
 
@@ -732,6 +1943,10 @@ def main(**kwds):
     except OSError:
         pass
 
+    if c.coverageStore:
+        c.coverageStore = os.path.abspath(
+            os.path.join(c.workingpath, c.coverageStore))
+
     with cd(c.workingpath):
         try:
             deploy(p, results)
@@ -763,6 +1978,9 @@ def main(**kwds):
                         .format(c.erpStartupTimeout))
 
                 testRepositories(p, results)
+
+            if c.blameProcesses:
+                blameFailures(p, results)
         finally:
             results.dump("results.yaml")
             #print(summary(results))
@@ -773,6 +1991,31 @@ def main(**kwds):
 
 
 
+@main.command(help="Adds a gzipped sql dump to a backup store as the given date. "
+    "Run it where the backups are made to have a store to use as backupSource.")
+@click.argument('backupfile', type=click.Path(exists=True, dir_okay=False))
+@click.argument('date')
+@click.option('--store',
+    metavar='PATH',
+    help='Backup store to add to, backupStore by default',
+    )
+@click.option('--keepdays', 'keptDays',
+    metavar='DAYS',
+    type=int,
+    help='Days to keep in the store, backupStoreDays by default',
+    )
+def storebackup(backupfile, date, store, keptDays):
+    store = store or c.backupStore
+    if not store:
+        fail("No backup store, use --store or set backupStore")
+    try:
+        datetime.datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        fail("Bad date '{}', expected YYYY-MM-DD".format(date))
+    storeBackup(store, date, Path(backupfile))
+    pruneBackupStore(store, keptDays or c.backupStoreDays)
+
+
 if __name__ == '__main__':
     main()
 